@@ -8,20 +8,20 @@ and truncate the image file to remove unused trailing space, using Linux command
 This script automates the process described below:
 
 1. Attach the disk image as a loop device with partitions scanned.
-2. Run filesystem check and calculate the minimum filesystem size.
+2. Calculate the minimum filesystem size and, if a shrink is needed, check the filesystem.
 3. Resize the filesystem to the minimum size to reclaim empty space.
 4. Resize the partition in the partition table to match the new filesystem size.
-5. Detach and re-attach the loop device to refresh the mappings.
-6. Calculate the new size for truncating the image file based on the partition offset and resized filesystem size.
-7. Detach the loop device and truncate the image file to remove unused space.
+5. Calculate the new size for truncating the image file based on the partition offset and resized filesystem size.
+6. Detach the loop device and truncate the image file to remove unused space.
 
 Requirements:
 - Linux environment with root privileges.
 - Installed command-line utilities (all available in standard GNU/Linux distributions):
-  losetup, partprobe, udevadm, lsblk, blockdev, fdisk, parted, e2fsck,
-  resize2fs, tune2fs, truncate, printf/echo.
+  losetup, lsblk, blkid, blockdev, parted, e2fsck,
+  resize2fs, tune2fs, sh.
 - The image must contain an ext2/3/4 filesystem in the last partition.
-- Script uses subprocess to invoke these utilities.
+- Script uses subprocess to invoke these utilities directly (no shell, except
+  for batching a few read-only probes into one ``sh -c``).
 
 Usage:
     sudo python3 shrenk.py /path/to/image.img
@@ -32,198 +32,504 @@ WARNING:
 
 """
 
+import ctypes
+import ctypes.util
+import fcntl
+import json
+import select
+import shlex
+import struct
 import subprocess
 import sys
-import re
 import os
 import time
-
-def run_cmd(cmd, capture_output=True, check=True):
-    """Run a shell command and return its output.
+from dataclasses import dataclass
+
+# Prefix for privileged commands; empty when already running as root, which
+# saves an exec of sudo (and its PAM lookup) on every call.
+SUDO: list[str] = [] if os.geteuid() == 0 else ["sudo"]
+
+# Labels of the values parsed out of resize2fs / tune2fs output
+_MIN_FS_KEY = "Estimated minimum size of the filesystem:"
+_BLOCK_SIZE_KEY = "Block size:"
+_FS_STATE_KEY = "Filesystem state:"
+_LAST_MOUNT_KEY = "Last mount time:"
+_LAST_CHECKED_KEY = "Last checked:"
+# Format of the timestamps printed by tune2fs -l (ctime style)
+_TUNE2FS_TIME_FORMAT = "%a %b %d %H:%M:%S %Y"
+# Block device ioctls (linux/fs.h)
+_BLKRRPART = 0x125F
+_BLKSSZGET = 0x1268
+# inotify(7) constants used by wait_for_device()
+_IN_CREATE = 0x00000100
+_IN_CLOEXEC = 0o2000000
+# On-disk partition table layout read by _read_mbr_partitions()
+_TABLE_SECTOR_SIZE = 512  # LBA unit assumed for tables inside image files
+_MBR_ENTRIES_OFFSET = 446
+_GPT_PROTECTIVE_TYPE = 0xEE
+_MBR_EXTENDED_TYPES = {0x05, 0x0F, 0x85}
+# Printed between commands by run_batch() to split the combined output; on
+# stdout it is followed by the exit status of the command before it.
+_BATCH_SEPARATOR = "---"
+
+def run_cmd(argv: list[str], capture_output=True, check=True, input_text=None):
+    """Run a command (given as an argv list, no shell) and return its output.
+    *input_text*, if given, is written to the command's stdin.
     Raises RuntimeError with detailed context if the command exits with a non-zero status (when *check* is True).
     """
     try:
         result = subprocess.run(
-            cmd,
-            shell=True,
+            argv,
+            shell=False,
             check=check,
             text=True,
+            input=input_text,
             stdout=subprocess.PIPE if capture_output else None,
             stderr=subprocess.PIPE,  # always capture stderr for diagnostics
         )
     except subprocess.CalledProcessError as exc:
-        raise RuntimeError(
-            f"Command failed: {cmd}\n"
-            f"Exit code: {exc.returncode}\n"
-            f"stdout: {exc.stdout}\n"
-            f"stderr: {exc.stderr}"
-        ) from exc
+        raise _command_error(argv, exc.returncode, exc.stdout, exc.stderr) from exc
 
     return result.stdout.strip() if capture_output else None
 
-def find_free_loop_device():
-    """Find a free loop device."""
-    out = run_cmd("losetup -f")
-    return out
+def _command_error(argv, returncode, stdout, stderr) -> RuntimeError:
+    """Build the RuntimeError reported for a failed command."""
+    return RuntimeError(
+        f"Command failed: {shlex.join(argv)}\n"
+        f"Exit code: {returncode}\n"
+        f"stdout: {stdout}\n"
+        f"stderr: {stderr}"
+    )
+
+def run_batch(cmds: list[list[str]], may_fail=()) -> list[subprocess.CompletedProcess]:
+    """Run several read-only commands in a single (sudo) ``sh -c`` and return one result per command.
+
+    This costs one fork/exec (and at most one sudo round trip) instead of one per command.
+    Each result carries the command's own exit status, stdout and stderr.  A failing
+    command raises the same RuntimeError as run_cmd() unless its index is listed in
+    *may_fail*, in which case the caller must check its returncode.
+    """
+    script = "".join(
+        f'{shlex.join(argv)}; echo "{_BATCH_SEPARATOR} $?"; echo {_BATCH_SEPARATOR} >&2; '
+        for argv in cmds
+    )
+    argv = [*SUDO, "sh", "-c", script]
+    try:
+        proc = subprocess.run(argv, check=True, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as exc:
+        raise _command_error(argv, exc.returncode, exc.stdout, exc.stderr) from exc
+
+    out_chunks: list[list[str]] = [[]]
+    statuses: list[int] = []
+    for line in proc.stdout.splitlines():
+        marker, _, status = line.partition(" ")
+        if marker == _BATCH_SEPARATOR and status.isdigit():
+            statuses.append(int(status))
+            out_chunks.append([])
+        else:
+            out_chunks[-1].append(line)
+    err_chunks: list[list[str]] = [[]]
+    for line in proc.stderr.splitlines():
+        if line == _BATCH_SEPARATOR:
+            err_chunks.append([])
+        else:
+            err_chunks[-1].append(line)
+    if len(statuses) != len(cmds) or len(err_chunks) != len(cmds) + 1:
+        raise _command_error(argv, proc.returncode, proc.stdout, proc.stderr)
+
+    results = [
+        subprocess.CompletedProcess(cmd, status, "\n".join(out).strip(), "\n".join(err).strip())
+        for cmd, status, out, err in zip(cmds, statuses, out_chunks, err_chunks)
+    ]
+    for i, result in enumerate(results):
+        if result.returncode != 0 and i not in may_fail:
+            raise _command_error(result.args, result.returncode, result.stdout, result.stderr)
+    return results
 
 def attach_loop_device(image_path):
     """Attach image to a loop device with partitions scanned (-P). Returns the loop device name."""
-    loop_dev = find_free_loop_device()
-    run_cmd(f"sudo losetup -P {loop_dev} {image_path}", capture_output=False)
-    # Ensure the kernel has created partition device nodes before proceeding
-    # Trigger a rescan and wait for udev to settle so that /dev/loopXpY exists.
-    run_cmd(f"sudo partprobe {loop_dev}", capture_output=False, check=False)
-    run_cmd("sudo udevadm settle", capture_output=False, check=False)
+    # -f --show picks a free device and prints its name, so no separate `losetup -f` is needed
+    loop_dev = run_cmd([*SUDO, "losetup", "-f", "--show", "-P", image_path])
+    # Trigger a rescan so the kernel publishes /dev/loopXpY; callers use
+    # wait_for_device() to block until the node actually exists.
+    reread_partition_table(loop_dev)
     return loop_dev
 
 def detach_loop_device(loop_dev):
     """Detach loop device."""
-    run_cmd(f"sudo losetup -d {loop_dev}", capture_output=False)
+    run_cmd([*SUDO, "losetup", "-d", loop_dev], capture_output=False)
+
+def _inotify_watch(directory: str):
+    """Return an inotify fd reporting entries created in *directory*, or None if unavailable."""
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        fd = libc.inotify_init1(_IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    if libc.inotify_add_watch(fd, os.fsencode(directory), _IN_CREATE) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+def reread_partition_table(loop_dev):
+    """Best-effort rescan of the partition table of a freshly attached *loop_dev*.
+    Issues the BLKRRPART ioctl directly; without root, falls back to `blockdev --rereadpt` via sudo.
+    Failures (e.g. EBUSY) are ignored, as `losetup -P` has already scanned the table.
+    """
+    try:
+        with open(loop_dev, "rb") as f:
+            fcntl.ioctl(f.fileno(), _BLKRRPART)
+    except PermissionError:
+        run_cmd([*SUDO, "blockdev", "--rereadpt", loop_dev], capture_output=False, check=False)
+    except OSError:
+        pass
 
 def wait_for_device(dev_path: str, timeout: int = 10):
-    """Block until *dev_path* exists or *timeout* seconds elapse."""
-    start = time.time()
-    while not os.path.exists(dev_path):
-        if time.time() - start > timeout:
-            raise RuntimeError(f"Device {dev_path} did not appear within {timeout} seconds")
-        time.sleep(0.2)
-
-def get_partition_start(loop_dev, part_num):
-    """Get start sector of a partition."""
-    output = run_cmd(f"sudo fdisk -l {loop_dev}")
-    # Example line: /dev/loop0p2   *       2048  62521343 62519296 29.8G 83 Linux
-    regex = re.compile(rf"{loop_dev}p{part_num}\s+\*?\s+(\d+)\s+(\d+)")
-    match = regex.search(output)
-    if not match:
-        raise RuntimeError(f"Partition {part_num} not found on {loop_dev}")
-    start_sector = int(match.group(1))
-    end_sector = int(match.group(2))
+    """Block until *dev_path* exists or *timeout* seconds elapse.
+
+    Sleeps on an inotify watch of the parent directory so we wake as soon as the
+    node is created; falls back to polling if inotify is not available.
+    """
+    if os.path.exists(dev_path):
+        return
+    fd = _inotify_watch(os.path.dirname(dev_path))
+    deadline = time.monotonic() + timeout
+    try:
+        # The watch is armed before this check, so a node created in between is not missed
+        while not os.path.exists(dev_path):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise RuntimeError(f"Device {dev_path} did not appear within {timeout} seconds")
+            if fd is None:
+                time.sleep(min(0.2, remaining))
+            elif select.select([fd], [], [], remaining)[0]:
+                os.read(fd, 4096)  # drain the events; the path check above decides
+    finally:
+        if fd is not None:
+            os.close(fd)
+
+def _lsblk_cmd(loop_dev: str) -> list[str]:
+    """Return the lsblk argv parsed by :func:`_parse_partitions`."""
+    return ["lsblk", "-b", "-J", "-o", "NAME,TYPE,START,SIZE", loop_dev]
+
+def _parse_partitions(loop_dev: str, output: str) -> list[dict]:
+    """Parse the JSON printed by :func:`_lsblk_cmd` into a partition list.
+    Raises RuntimeError if *output* is not valid lsblk JSON.
+
+    Each entry holds ``num``, ``name`` (device path), ``start`` and ``size``
+    (both in bytes).
+    """
+    base = os.path.basename(loop_dev) + "p"
+    partitions: list[dict] = []
+    try:
+        devices = json.loads(output).get("blockdevices", [])
+    except ValueError as exc:
+        raise RuntimeError(f"Could not parse lsblk output for {loop_dev}:\n{output}") from exc
+    for dev in devices:
+        for child in dev.get("children", []):
+            name = child.get("name", "")
+            suffix = name[len(base):]
+            if child.get("type") != "part" or not name.startswith(base) or not suffix.isdigit():
+                continue
+            partitions.append({
+                "num": int(suffix),
+                "name": f"/dev/{name}",
+                # lsblk reports START in 512-byte units regardless of sector size
+                "start": int(child["start"]) * 512,
+                "size": int(child["size"]),
+            })
+    return partitions
+
+def _find_partition(partitions: list[dict], part_num: int) -> dict:
+    """Return the entry for *part_num* from a :func:`_parse_partitions` list."""
+    for part in partitions:
+        if part["num"] == part_num:
+            return part
+    raise RuntimeError(f"Partition {part_num} not found")
+
+def get_partition_start(partitions: list[dict], part_num: int, sector_size: int):
+    """Get start and end sector of a partition."""
+    part = _find_partition(partitions, part_num)
+    start_sector = part["start"] // sector_size
+    end_sector = start_sector + part["size"] // sector_size - 1
     return start_sector, end_sector
 
 def list_partition_numbers(loop_dev: str) -> list[int]:
-    """Return integer partition numbers for *loop_dev* using lsblk."""
-    output = run_cmd(f"lsblk -ln -o NAME,TYPE {loop_dev}")
-    base = os.path.basename(loop_dev) + "p"
+    """Return integer partition numbers for *loop_dev* as published in sysfs."""
+    name = os.path.basename(loop_dev)
     part_nums: list[int] = []
-    for line in output.splitlines():
-        parts = line.split()
-        if len(parts) != 2:
-            continue
-        name, typ = parts
-        if typ != "part" or not name.startswith(base):
-            continue
-        suffix = name[len(base):]
-        if suffix.isdigit():
+    for entry in os.listdir(f"/sys/block/{name}"):
+        suffix = entry[len(name) + 1:]
+        if entry.startswith(name + "p") and suffix.isdigit():
             part_nums.append(int(suffix))
     return part_nums
 
 def get_sector_size(loop_dev):
-    """Get sector size (usually 512 bytes)."""
-    output = run_cmd(f"blockdev --getss {loop_dev}")
-    return int(output)
+    """Get sector size (usually 512 bytes) with the BLKSSZGET ioctl.
+    Without root, falls back to `blockdev --getss` via sudo.
+    """
+    try:
+        with open(loop_dev, "rb") as f:
+            buf = fcntl.ioctl(f.fileno(), _BLKSSZGET, b"\0" * 4)
+    except PermissionError:
+        return int(run_cmd([*SUDO, "blockdev", "--getss", loop_dev]))
+    return struct.unpack("i", buf)[0]
+
+@dataclass
+class LoopCtx:
+    """Metadata of the last partition of an attached image, probed once per attach."""
+    loop_dev: str
+    part_num: int
+    sector_size: int
+    block_size: int
+    start_sector: int
+    end_sector: int
+    fstype: str
+    needs_fsck: bool
+
+    @property
+    def part_dev(self) -> str:
+        return f"{self.loop_dev}p{self.part_num}"
+
+def probe(loop_dev: str) -> LoopCtx:
+    """Collect the metadata of the last partition on *loop_dev* into a :class:`LoopCtx`.
+
+    The partition table, the filesystem type and the ext superblock are read in
+    a single batched call, so downstream steps do not need to query the device again.
+    The type comes from `blkid -p`, which probes the device itself rather than
+    relying on udev having processed the new partition yet.
+    """
+    # We assume last partition number is the highest numbered partition on loop device
+    part_nums = list_partition_numbers(loop_dev)
+    if not part_nums:
+        raise RuntimeError("No partitions found on the loop device.")
+    part_num = max(part_nums)
+    part_dev = f"{loop_dev}p{part_num}"
+    wait_for_device(part_dev)
+
+    # tune2fs and blkid fail on a non-ext partition; that is reported as a type error below
+    lsblk, tune2fs, blkid = run_batch([
+        _lsblk_cmd(loop_dev),
+        ["tune2fs", "-l", part_dev],
+        ["blkid", "-p", "-o", "value", "-s", "TYPE", part_dev],
+    ], may_fail=(1, 2))
+    partitions = _parse_partitions(loop_dev, lsblk.stdout)
+    sector_size = get_sector_size(loop_dev)
+    start_sector, end_sector = get_partition_start(partitions, part_num, sector_size)
+    # blkid exits with 2 when it finds no known filesystem; anything else is a real failure
+    if blkid.returncode not in (0, 2):
+        raise _command_error(blkid.args, blkid.returncode, blkid.stdout, blkid.stderr)
+    fstype = blkid.stdout
+    # Check the type before looking at tune2fs, which only fails expectedly for non-ext filesystems
+    assert_ext_filesystem(part_dev, fstype)
+    if tune2fs.returncode != 0:
+        raise _command_error(tune2fs.args, tune2fs.returncode, tune2fs.stdout, tune2fs.stderr)
+    tune2fs_out = tune2fs.stdout
+    block_size = _parse_block_size(part_dev, tune2fs_out)
+    return LoopCtx(loop_dev, part_num, sector_size, block_size, start_sector, end_sector,
+                   fstype, _needs_fsck(tune2fs_out))
+
+def _read_mbr_partitions(image_path: str) -> list[tuple[int,int,int]]:
+    """Read the partition table directly from *image_path*, without a loop device.
+
+    Returns ``(num, start_lba, size_lba)`` for every used MBR partition, in
+    512-byte sectors.  Logical partitions (5+) are collected by following the
+    extended partition's EBR chain, and the extended container itself is left out.
+    A protective MBR hands over to :func:`_read_gpt_partitions`.  An image
+    without a partition table (no 0x55AA signature) yields an empty list.
+    """
+    with open(image_path, "rb") as f:
+        mbr = f.read(_TABLE_SECTOR_SIZE)
+        if len(mbr) < _TABLE_SECTOR_SIZE or mbr[510:512] != b"\x55\xaa":
+            return []
+        parts: list[tuple[int,int,int]] = []
+        for i in range(4):
+            # status, CHS first (3), type, CHS last (3), first LBA, sector count
+            entry = struct.unpack_from("<BBBBBBBBII", mbr, _MBR_ENTRIES_OFFSET + 16 * i)
+            part_type, start_lba, size_lba = entry[4], entry[8], entry[9]
+            if part_type == _GPT_PROTECTIVE_TYPE:
+                return _read_gpt_partitions(f, image_path)
+            if part_type in _MBR_EXTENDED_TYPES:
+                parts.extend(_read_logical_partitions(f, image_path, start_lba))
+            elif part_type and size_lba:
+                parts.append((i + 1, start_lba, size_lba))
+        return sorted(parts)
+
+def _read_logical_partitions(f, image_path: str, extended_lba: int) -> list[tuple[int,int,int]]:
+    """Walk the EBR chain of the extended partition at *extended_lba*; numbered from 5 like the kernel."""
+    parts: list[tuple[int,int,int]] = []
+    ebr_lba, seen = extended_lba, set()
+    while ebr_lba not in seen:  # guard against a looping chain in a corrupt image
+        seen.add(ebr_lba)
+        f.seek(ebr_lba * _TABLE_SECTOR_SIZE)
+        ebr = f.read(_TABLE_SECTOR_SIZE)
+        if len(ebr) < _TABLE_SECTOR_SIZE or ebr[510:512] != b"\x55\xaa":
+            raise RuntimeError(f"Invalid extended boot record at sector {ebr_lba} in {image_path}")
+        # First entry: the logical partition, relative to this EBR.
+        # Second entry: the next EBR, relative to the start of the extended partition.
+        logical = struct.unpack_from("<BBBBBBBBII", ebr, _MBR_ENTRIES_OFFSET)
+        link = struct.unpack_from("<BBBBBBBBII", ebr, _MBR_ENTRIES_OFFSET + 16)
+        if logical[4] and logical[9]:
+            parts.append((5 + len(parts), ebr_lba + logical[8], logical[9]))
+        if not link[4] or not link[8]:
+            break
+        ebr_lba = extended_lba + link[8]
+    return parts
+
+def _read_gpt_partitions(f, image_path: str) -> list[tuple[int,int,int]]:
+    """Read the primary GPT of the open image *f*; same result format as :func:`_read_mbr_partitions`."""
+    f.seek(_TABLE_SECTOR_SIZE)  # primary header lives in LBA 1
+    header = f.read(92)
+    if header[:8] != b"EFI PART":
+        raise RuntimeError(f"Invalid GPT header in {image_path}")
+    entries_lba, num_entries, entry_size = struct.unpack_from("<QII", header, 72)
+    f.seek(entries_lba * _TABLE_SECTOR_SIZE)
+    table = f.read(num_entries * entry_size)
+    parts: list[tuple[int,int,int]] = []
+    for i in range(num_entries):
+        offset = i * entry_size
+        if table[offset:offset + 16] == bytes(16):  # all-zero type GUID marks an unused entry
+            continue
+        first_lba, last_lba = struct.unpack_from("<QQ", table, offset + 32)
+        parts.append((i + 1, first_lba, last_lba - first_lba + 1))
+    return parts
 
 def display_image_layout(image_path: str, bar_width: int = 60):
-    """Attach the image and print an ASCII bar showing partition positions."""
-    loop_dev = attach_loop_device(image_path)
-    try:
-        sector_size = get_sector_size(loop_dev)
-        fdisk_out = run_cmd(f"sudo fdisk -l {loop_dev}")
-        part_regex = re.compile(rf"{re.escape(loop_dev)}p(\d+)\s+\*?\s+(\d+)\s+(\d+)")
-        parts: list[tuple[int,int,int]] = []  # (num, start, end)
-        for line in fdisk_out.splitlines():
-            m = part_regex.search(line)
-            if m:
-                parts.append((int(m.group(1)), int(m.group(2)), int(m.group(3))))
-        if not parts:
-            print("[layout] No partitions found to display.")
-            return
-        total_sectors = max(end for _num, _start, end in parts) + 1
-        bar = [' '] * bar_width
-        for num, start, end in parts:
-            left = int(start * bar_width / total_sectors)
-            right = max(left + 1, int((end + 1) * bar_width / total_sectors))
-            for i in range(left, min(right, bar_width)):
-                bar[i] = str(num % 10)
-        print("\nDisk image partition layout (each character ~{:.0f}% of image):".format(100 / bar_width))
-        print('|' + ''.join(bar) + '|')
-        legend = ' '.join(f"{num}: {((end-start+1)*sector_size)//(1024*1024)}MB" for num, start, end in parts)
-        print("Legend:", legend)
-    finally:
-        detach_loop_device(loop_dev)
+    """Print an ASCII bar showing partition positions, read straight from the image file."""
+    sector_size = _TABLE_SECTOR_SIZE
+    parts: list[tuple[int,int,int]] = [  # (num, start, end)
+        (num, start, start + size - 1) for num, start, size in _read_mbr_partitions(image_path)
+    ]
+    if not parts:
+        print("[layout] No partitions found to display.")
+        return
+    total_sectors = max(end for _num, _start, end in parts) + 1
+    bar = bytearray(b' ' * bar_width)
+    for num, start, end in parts:
+        left = int(start * bar_width / total_sectors)
+        right = min(max(left + 1, int((end + 1) * bar_width / total_sectors)), bar_width)
+        if right > left:
+            bar[left:right] = bytes([ord('0') + num % 10]) * (right - left)
+    print("\nDisk image partition layout (each character ~{:.0f}% of image):".format(100 / bar_width))
+    print('|' + bar.decode() + '|')
+    legend = ' '.join(f"{num}: {((end-start+1)*sector_size)//(1024*1024)}MB" for num, start, end in parts)
+    print("Legend:", legend)
 
 def e2fsck_partition(part_dev):
     """Run a filesystem check on ext filesystem without interactive prompts."""
-    run_cmd(f"sudo e2fsck -f -y {part_dev}", capture_output=False)
+    run_cmd([*SUDO, "e2fsck", "-f", "-y", part_dev], capture_output=False)
+
+def _line_after(output: str, key: str):
+    """Return the rest of the line following *key* in *output*, or None if *key* is absent.
+
+    A plain substring search; cheaper than a regex for these short, fixed labels.
+    """
+    i = output.find(key)
+    if i < 0:
+        return None
+    return output[i + len(key):].split("\n", 1)[0].strip()
+
+def _field_after(output: str, key: str):
+    """Return the first word following *key* in *output*, or None if *key* is absent."""
+    rest = _line_after(output, key)
+    return rest.split(None, 1)[0] if rest else None
+
+def _parse_tune2fs_time(value):
+    """Convert a tune2fs timestamp to seconds since the epoch; None for 'n/a' or unparsable values."""
+    try:
+        return time.mktime(time.strptime(value, _TUNE2FS_TIME_FORMAT))
+    except (TypeError, ValueError, OverflowError):
+        return None
 
 def get_min_filesystem_blocks(part_dev):
     """Get minimum size in filesystem blocks for resize2fs."""
-    output = run_cmd(f"sudo resize2fs -P {part_dev}")
+    output = run_cmd([*SUDO, "resize2fs", "-P", part_dev])
     # sample output: resize2fs 1.45.5 (07-Jan-2020)
     # Estimated minimum size of the filesystem: 251648
-    match = re.search(r"Estimated minimum size of the filesystem: (\d+)", output)
-    if not match:
+    value = _field_after(output, _MIN_FS_KEY)
+    if value is None or not value.isdigit():
         raise RuntimeError(f"Failed to get minimum filesystem size from resize2fs output.")
-    return int(match.group(1))
+    return int(value)
 
-def get_block_size(part_dev):
-    """Get filesystem block size from tune2fs."""
-    output = run_cmd(f"sudo tune2fs -l {part_dev}")
-    match = re.search(r"Block size:\s*(\d+)", output)
-    if not match:
+def _parse_block_size(part_dev, output):
+    """Extract the block size from ``tune2fs -l`` output for *part_dev*."""
+    value = _field_after(output, _BLOCK_SIZE_KEY)
+    if value is None or not value.isdigit():
         raise RuntimeError(f"Failed to get block size for {part_dev}")
-    return int(match.group(1))
+    return int(value)
+
+def _needs_fsck(tune2fs_out: str) -> bool:
+    """Return True unless ``tune2fs -l`` shows a clean filesystem checked since its last mount.
 
-def resize_filesystem(part_dev, blocks=None):
+    These are the conditions under which resize2fs itself demands an
+    `e2fsck -f` first, so skipping the check otherwise is safe.
+    """
+    if _line_after(tune2fs_out, _FS_STATE_KEY) != "clean":
+        return True
+    last_checked = _parse_tune2fs_time(_line_after(tune2fs_out, _LAST_CHECKED_KEY))
+    if last_checked is None:
+        return True
+    last_mount = _parse_tune2fs_time(_line_after(tune2fs_out, _LAST_MOUNT_KEY))
+    return last_mount is not None and last_mount > last_checked
+
+def resize_filesystem(ctx: LoopCtx, blocks=None):
     """Resize filesystem. If blocks given, resize to that many blocks; else shrink to partition size."""
     if blocks:
-        run_cmd(f"sudo resize2fs {part_dev} {blocks}", capture_output=False)
+        run_cmd([*SUDO, "resize2fs", ctx.part_dev, str(blocks)], capture_output=False)
     else:
-        run_cmd(f"sudo resize2fs {part_dev}", capture_output=False)
+        run_cmd([*SUDO, "resize2fs", ctx.part_dev], capture_output=False)
+
+def run_parted(loop_dev, directives: list[str]):
+    """
+    Run several parted commands on *loop_dev* in a single parted session.
+    *directives* are sent one per line (answers to parted's prompts included),
+    preceded by `unit s` and followed by `quit`.
+    Uses `--pretend-input-tty` so that prompts such as the shrink warning read
+    their answer from stdin; script mode (-s) would take commands from argv and
+    could not confirm a shrinking resizepart.
+    """
+    script = "unit s\n" + "".join(f"{directive}\n" for directive in directives) + "quit\n"
+    run_cmd([*SUDO, "parted", loop_dev, "---pretend-input-tty"], capture_output=False, input_text=script)
 
-def resize_partition(loop_dev, part_num, new_end):
+def resize_partition(ctx: LoopCtx, new_end):
     """
-    Resize partition (part_num) to new end using parted.
+    Resize the partition described by *ctx* to new end using parted.
     new_end is string like '40GB', '30GiB', or percent '100%', or sector count '950000s'.
-    Uses `--pretend-input-tty` and pipes the confirmation response so that shrinking
-    operations do not cause parted to abort in non-interactive mode.
+    The confirmation and a `print` of the resulting table share the same parted session.
     """
-    # Build an interactive command script for parted.
     # We send:
     #   resizepart <num> <end>
     #   Yes
-    #   quit
-    script = (
-        f"resizepart {part_num} {new_end}\n"
-        "Yes\n"
-        "quit\n"
-    )
-    cmd = f"printf '{script}' | sudo parted {loop_dev} ---pretend-input-tty"
-    run_cmd(cmd, capture_output=False)
+    #   print
+    run_parted(ctx.loop_dev, [
+        f"resizepart {ctx.part_num} {new_end}",
+        "Yes",
+        "print",
+    ])
 
 def truncate_image(image_path, new_size):
-    """Truncate image file to new_size bytes."""
-    run_cmd(f"truncate -s {new_size} {image_path}", capture_output=False)
+    """Truncate image file to new_size bytes (needs write access, i.e. run as root)."""
+    os.truncate(image_path, new_size)
 
-def assert_ext_filesystem(part_dev: str):
-    """Abort if *part_dev* is not an ext2/3/4 filesystem."""
-    fstype = run_cmd(f"sudo blkid -o value -s TYPE {part_dev}")
+def assert_ext_filesystem(part_dev: str, fstype: str):
+    """Abort if *fstype*, the filesystem type of *part_dev*, is not ext2/3/4."""
     if fstype not in {"ext2", "ext3", "ext4"}:
         raise RuntimeError(
             f"Unsupported filesystem type '{fstype}' on {part_dev}. "
             "This script only handles ext2/3/4."
         )
 
-def can_shrink(loop_dev: str, part_num: int, target_bytes: int) -> bool:
+def can_shrink(ctx: LoopCtx, target_bytes: int) -> bool:
     """Return True if the partition size (in bytes) exceeds *target_bytes*.
 
     A small 1-sector tolerance is allowed so that rounding differences do not
     prevent a shrink that would otherwise succeed.
     """
-    start_sector, end_sector = get_partition_start(loop_dev, part_num)
-    sector_size = get_sector_size(loop_dev)
-    current_bytes = (end_sector - start_sector + 1) * sector_size
+    current_bytes = (ctx.end_sector - ctx.start_sector + 1) * ctx.sector_size
     # Allow a one-sector tolerance
-    return current_bytes - target_bytes > sector_size
+    return current_bytes - target_bytes > ctx.sector_size
 
 def main(image_path):
     print(f"Starting resize and truncate process for {image_path}")
@@ -234,28 +540,30 @@ def main(image_path):
     print(f"Image attached as {loop_dev}")
 
     try:
-        # We assume last partition number is the highest numbered partition on loop device:
-        part_nums = list_partition_numbers(loop_dev)
-        if not part_nums:
-            raise RuntimeError("No partitions found on the loop device.")
-        last_part_num = max(part_nums)
-        part_dev = f"{loop_dev}p{last_part_num}"
-        wait_for_device(part_dev)
-        # Early sanity check: ensure the partition hosts an ext-family filesystem
-        assert_ext_filesystem(part_dev)
+        # Probe the last partition once; this also ensures it hosts an ext-family filesystem
+        ctx = probe(loop_dev)
+        part_dev = ctx.part_dev
         print(f"Using last partition: {part_dev}")
 
-        # Run filesystem check
-        print("Checking filesystem for errors...")
-        e2fsck_partition(part_dev)
-
-        # Get minimal filesystem size in blocks
+        # Get minimal filesystem size in blocks.  resize2fs -P is a quick read-only
+        # estimate, so it runs before the slow filesystem check: an image that is
+        # already minimal exits without paying for e2fsck at all.
         print("Getting minimum filesystem size...")
-        min_blocks = get_min_filesystem_blocks(part_dev)
+        checked = False
+        try:
+            min_blocks = get_min_filesystem_blocks(part_dev)
+        except RuntimeError:
+            if not ctx.needs_fsck:
+                raise
+            # resize2fs refuses to estimate a filesystem with errors; check it first
+            print("Checking filesystem for errors...")
+            e2fsck_partition(part_dev)
+            checked = True
+            min_blocks = get_min_filesystem_blocks(part_dev)
         print(f"Minimum filesystem size (blocks): {min_blocks}")
 
         # Get block size
-        block_size = get_block_size(part_dev)
+        block_size = ctx.block_size
         print(f"Filesystem block size: {block_size} bytes")
 
         # Apply safety margin so the filesystem is not 100% full after shrinking
@@ -265,23 +573,40 @@ def main(image_path):
         print(f"Target filesystem size (blocks) with {SAFETY_MB} MB margin: {target_blocks}")
 
         # Check if shrinking is actually needed/possible
-        fs_size_bytes_target = target_blocks * block_size
-        if not can_shrink(loop_dev, last_part_num, fs_size_bytes_target):
+        if not can_shrink(ctx, target_blocks * block_size):
             print("The partition is already at or near its target minimal size. No shrinking necessary.")
             return
 
+        # Run filesystem check, now that we know the shrink will happen.  The check
+        # can change block usage, so the estimate is refreshed afterwards.
+        # This stays strictly sequential on purpose: every read-only probe (partition
+        # table, sector size, fs type, superblock) has already finished in probe(),
+        # and everything after this point (resize2fs -P, resize2fs, parted) must see
+        # the checked filesystem, so there is nothing left to overlap with e2fsck.
+        if ctx.needs_fsck and not checked:
+            print("Checking filesystem for errors...")
+            e2fsck_partition(part_dev)
+            min_blocks = get_min_filesystem_blocks(part_dev)
+            target_blocks = min_blocks + extra_blocks
+            print(f"Target filesystem size (blocks) after check: {target_blocks}")
+            if not can_shrink(ctx, target_blocks * block_size):
+                print("The partition is already at or near its target minimal size. No shrinking necessary.")
+                return
+        elif not ctx.needs_fsck:
+            print("Filesystem is clean and was checked after its last mount; skipping e2fsck.")
+
+        # Get partition start sector and end sector; shrinking only moves the end,
+        # so start_sector stays valid for the rest of the run
+        start_sector, sector_size = ctx.start_sector, ctx.sector_size
+        print(f"Partition {ctx.part_num} start sector: {start_sector}, current end sector: {ctx.end_sector}")
+
         # Resize filesystem to target size
         print("Resizing filesystem to target size (minimum + safety margin)...")
         #input ("Press enter to continue...")
-        resize_filesystem(part_dev, target_blocks)
+        resize_filesystem(ctx, target_blocks)
         print("Filesystem resized.")
 
-        # Get partition start sector and end sector
-        start_sector, end_sector = get_partition_start(loop_dev, last_part_num)
-        print(f"Partition {last_part_num} start sector: {start_sector}, current end sector: {end_sector}")
-
         # Calculate new partition size in bytes from target_blocks and block size
-        sector_size = get_sector_size(loop_dev)
         fs_size_bytes = target_blocks * block_size
         print(f"Device sector size: {sector_size} bytes")
 
@@ -291,37 +616,24 @@ def main(image_path):
         print(f"New partition end sector: {new_end_sector}")
 
         # Resize partition to new end (in sectors)
-        print(f"Resizing partition {last_part_num} to end at sector {new_end_sector}...")
-        resize_partition(loop_dev, last_part_num, f"{new_end_sector}s")
+        print(f"Resizing partition {ctx.part_num} to end at sector {new_end_sector}...")
+        resize_partition(ctx, f"{new_end_sector}s")
         print("Partition resized.")
 
-    finally:
-        # Detach loop device to flush changes and free mappings
-        print(f"Detaching loop device {loop_dev} to refresh...")
-        detach_loop_device(loop_dev)
-
-    # Reattach loop device to refresh
-    loop_dev = attach_loop_device(image_path)
-    print(f"Reattached image as {loop_dev}")
-    part_dev = f"{loop_dev}p{last_part_num}"
-    wait_for_device(part_dev)
-
-    # Calculate truncate size: partition start byte + filesystem size bytes
-    # ext2/3/4 block sizes (1 KiB, 2 KiB, 4 KiB) are multiples of the usual 512-byte
-    # device sector size, so `fs_size_bytes` is already sector-aligned and the
-    # following computation is safe.  If you ever use unusual block/sector
-    # combinations, a future-proof alternative is:
-    #     truncate_size = (start_sector + fs_size_sectors) * sector_size
-    start_sector, end_sector = get_partition_start(loop_dev, last_part_num)
-    sector_size = get_sector_size(loop_dev)
-    fs_size_bytes = target_blocks * block_size
-    truncate_size = start_sector * sector_size + fs_size_bytes
+        # Calculate truncate size: partition start byte + filesystem size bytes
+        # ext2/3/4 block sizes (1 KiB, 2 KiB, 4 KiB) are multiples of the usual 512-byte
+        # device sector size, so `fs_size_bytes` is already sector-aligned and the
+        # following computation is safe.  If you ever use unusual block/sector
+        # combinations, a future-proof alternative is:
+        #     truncate_size = (start_sector + fs_size_sectors) * sector_size
+        truncate_size = start_sector * sector_size + fs_size_bytes
 
-    print(f"Calculated truncate size for image: {truncate_size} bytes (~{truncate_size//(1024*1024)} MB)")
+        print(f"Calculated truncate size for image: {truncate_size} bytes (~{truncate_size//(1024*1024)} MB)")
 
-    # Detach loop device before truncating
-    print(f"Detaching loop device {loop_dev} before truncating image...")
-    detach_loop_device(loop_dev)
+    finally:
+        # Detach loop device before truncating (or on error) to free mappings
+        print(f"Detaching loop device {loop_dev}...")
+        detach_loop_device(loop_dev)
 
     # Truncate the image file
     print("Truncating image file to remove unused trailing space...")